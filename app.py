@@ -1,26 +1,32 @@
 from flask import Flask, request, redirect, jsonify
 from models import connect_db, Doctor, db,  Appointment
+from responses import connect_compression, cached_listing
+from query_budget import query_budget
+from config import DATABASE_URI
 
 app = Flask(__name__)
 
-# Database URI needs to be changed to the name of your database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///doctor-calendar' # Here
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = True
 
 app.config['SECRET_KEY'] = "SECRET!"
 
 connect_db(app)
+connect_compression(app)
 db.create_all()
 
 ############################# Doctors routes ###################################
 @app.get('/')
+@query_budget(0)
 def redirect_to_doctors():
     """Redirects to the doctors endpoint. Gives status code of 302."""
 
     return redirect('/doctors')
 
+# Listing version, then the SELECT if the cached listing is out of date
 @app.get('/doctors')
+@query_budget(2)
 def list_doctors():
     """Get's a list of all doctors and returns as JSON like:
         {"doctors": [{
@@ -29,15 +35,18 @@ def list_doctors():
             last_name
             }], ....
         }
+        The encoded list is cached until the doctors table changes.
     """
 
-    doctors = Doctor.query.all()
-    # Need to serialize to normal dict instead of obj if returning as JSON
-    doctors = [doctor.serialize() for doctor in doctors]
+    def build():
+        doctors = Doctor.query.all()
+        # Need to serialize to normal dict instead of obj if returning as JSON
+        return [doctor.serialize() for doctor in doctors]
 
-    return jsonify(doctors)
+    return cached_listing('doctors', build)
 
 @app.get('/doctors/<int:id>')
+@query_budget(1)
 def list_doctor(id):
     """ Takes doctor's id in the pathway. gets doctor.
         If successful, returns JSON of {"doctor":{id,first_name,last_name}}
@@ -48,7 +57,9 @@ def list_doctor(id):
 
     return jsonify({"doctor":doctor.serialize()})
 
+# INSERT, then a SELECT to reload the doctor after commit
 @app.post('/doctors')
+@query_budget(2)
 def create_doctor():
     """ Takes first_name and last_name sent in body of request.
         Creates a new doctor. Returns JSON of {"posted_doctor":{id,first_name,last_name}}
@@ -69,7 +80,9 @@ def create_doctor():
     return jsonify({"posted_doctor":doctor.serialize()}), 201
 
 ############################# Appointments routes ##############################
+# Listing version, then the SELECT if the cached listing is out of date
 @app.get('/appointments')
+@query_budget(2)
 def list_appointments():
     """Get's a list of all appointments and returns as JSON like:
         {"appointments": [{
@@ -81,15 +94,19 @@ def list_appointments():
             doctor_id
             }], ....
         }
+        The encoded list is cached until the appointments table changes.
     """
 
-    appointments = Appointment.query.all()
-    # Need to serialize to normal dict instead of obj if returning as JSON
-    appointments = [appointment.serialize() for appointment in appointments]
+    def build():
+        appointments = Appointment.query.all()
+        # Need to serialize to normal dict instead of obj if returning as JSON
+        return [appointment.serialize() for appointment in appointments]
 
-    return jsonify(appointments)
+    return cached_listing('appointments', build)
 
+# Doctor, then all of the doctor's appointments
 @app.get('/appointments/<int:doctor_id>/<month>/<day>/<year>')
+@query_budget(2)
 def list_appointments_for_doctor_on_day(doctor_id, month, day, year):
     """ Takes doctor's id, month, day, and year in pathway.
         If successful, returns JSON of {"appointments": [{
@@ -111,7 +128,9 @@ def list_appointments_for_doctor_on_day(doctor_id, month, day, year):
 
     return jsonify({"appointments":[appointment.serialize() for appointment in appointments]})
 
+# Doctor, doctor's appointments, INSERT, then reload after commit
 @app.post('/appointments/<int:doctor_id>')
+@query_budget(4)
 def create_appointment(doctor_id):
     """ Takes in pathway:
             doctor_id
@@ -186,6 +205,7 @@ def create_appointment(doctor_id):
     return jsonify({"posted_appointment":appointment.serialize()}), 201
 
 @app.delete('/appointments/<int:id>')
+@query_budget(2)
 def delete_appointment(id):
     """ Takes appointment's id in the pathway. Deletes appointment.
         If successful, returns JSON of {"deleted":id}
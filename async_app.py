@@ -0,0 +1,207 @@
+from quart import Quart, request, abort, jsonify
+from quart.utils import run_sync
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from config import DATABASE_URI
+from models import Doctor, Appointment, ListingVersion
+from query_budget import query_budget
+from responses import (DEFAULT_MIN_SIZE, EncodedListing, is_compressible,
+    compress_body, listing_encoding, listing_response, listings)
+
+# Serves the read routes of app.py without tying up a thread per request.
+# While a request waits on Postgres its worker serves other requests, so
+# one worker can hold thousands of polling clients. Run it with:
+#     hypercorn async_app:app
+# Writes still go to the Flask app in app.py, the JSON is the same.
+# The full listings use the same cache as app.py, see responses.ListingCache.
+app = Quart(__name__)
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+app.config['SQLALCHEMY_ECHO'] = True
+
+# Connections kept open in the pool, requests over this wait for one to free up
+app.config['ASYNC_POOL_SIZE'] = 20
+app.config['ASYNC_MAX_OVERFLOW'] = 10
+
+app.config['COMPRESS_MIN_SIZE'] = DEFAULT_MIN_SIZE
+
+# libpq options from DATABASE_URL that asyncpg takes under another name,
+# as (asyncpg argument, convert)
+ASYNCPG_CONNECT_ARGS = {
+    'sslmode': ('ssl', str),
+    'connect_timeout': ('timeout', float)
+}
+# libpq options asyncpg has no equivalent for, dropped from the URL
+LIBPQ_ONLY_OPTIONS = ('sslcert', 'sslkey', 'sslrootcert', 'sslcrl',
+    'target_session_attrs')
+
+# Set when the app starts serving
+engine = None
+async_session = None
+
+def asyncpg_url(uri):
+    """ Takes the database URI app.py uses, with any postgres driver.
+        Returns the same database's URL for asyncpg and the connect_args for
+        the options asyncpg spells differently.
+    """
+
+    url = make_url(uri).set(drivername='postgresql+asyncpg')
+    query = dict(url.query)
+    connect_args = {}
+
+    for option, (argument, convert) in ASYNCPG_CONNECT_ARGS.items():
+        if option in query:
+            connect_args[argument] = convert(query.pop(option))
+
+    if 'application_name' in query:
+        connect_args['server_settings'] = {
+            'application_name': query.pop('application_name')
+        }
+
+    for option in LIBPQ_ONLY_OPTIONS:
+        query.pop(option, None)
+
+    return url.set(query=query), connect_args
+
+@app.before_serving
+async def connect_async_db():
+    """ Creates the asyncpg connection pool """
+    global engine, async_session
+
+    # Same database as app.py, but through the asyncpg driver
+    url, connect_args = asyncpg_url(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    engine = create_async_engine(
+        url,
+        connect_args=connect_args,
+        echo=app.config['SQLALCHEMY_ECHO'],
+        pool_size=app.config['ASYNC_POOL_SIZE'],
+        max_overflow=app.config['ASYNC_MAX_OVERFLOW']
+    )
+    async_session = sessionmaker(
+        engine,
+        class_=AsyncSession,
+        expire_on_commit=False
+    )
+
+@app.after_serving
+async def disconnect_async_db():
+    """ Closes every connection in the pool """
+
+    await engine.dispose()
+
+@app.after_request
+async def compress_response(response):
+    """ Compresses JSON responses, same as responses.compress_response does
+        for app.py. Compressing runs in a thread so it doesn't hold up every
+        other request on the event loop.
+    """
+
+    if not is_compressible(response):
+        return response
+
+    return await run_sync(compress_body)(
+        response,
+        await response.get_data(),
+        request.accept_encodings,
+        app.config['COMPRESS_MIN_SIZE']
+    )
+
+async def cached_listing(name, model):
+    """ Async version of responses.cached_listing. Returns a response for the
+        listing called name, only selecting every row of model if the listing
+        changed since it was cached. Encoding the JSON and compressing it run
+        in a thread, off the event loop.
+    """
+
+    async with async_session() as session:
+        # Read before the rows, so they're at least as new as the version
+        # they are stored under
+        version = (await session.execute(
+            select(ListingVersion.version).where(ListingVersion.name == name)
+        )).scalar()
+        listing = listings.get(name, version)
+
+        if listing is None:
+            rows = (await session.execute(select(model))).scalars().all()
+
+            def encode():
+                return jsonify([row.serialize() for row in rows])
+
+            response = await run_sync(encode)()
+            listing = EncodedListing(
+                await response.get_data(), response.mimetype, version)
+
+            if version is not None:
+                listings.put(name, listing)
+
+    encoding = listing_encoding(
+        listing,
+        request.accept_encodings,
+        app.config['COMPRESS_MIN_SIZE']
+    )
+
+    return listing_response(
+        app.response_class,
+        await run_sync(listing.get)(encoding),
+        listing.mimetype,
+        encoding
+    )
+
+############################# Doctors routes ###################################
+# Listing version, then the SELECT if the cached listing is out of date
+@app.get('/doctors')
+@query_budget(2)
+async def list_doctors():
+    """ Same as list_doctors in app.py, cached the same way """
+
+    return await cached_listing('doctors', Doctor)
+
+@app.get('/doctors/<int:id>')
+@query_budget(1)
+async def list_doctor(id):
+    """ Same as list_doctor in app.py, 404 if the doctor doesn't exist """
+
+    async with async_session() as session:
+        doctor = await session.get(Doctor, id)
+
+    if doctor is None:
+        abort(404)
+
+    return jsonify({"doctor":doctor.serialize()})
+
+############################# Appointments routes ##############################
+# Listing version, then the SELECT if the cached listing is out of date
+@app.get('/appointments')
+@query_budget(2)
+async def list_appointments():
+    """ Same as list_appointments in app.py, cached the same way """
+
+    return await cached_listing('appointments', Appointment)
+
+# Doctor, then the doctor's appointments on the day
+@app.get('/appointments/<int:doctor_id>/<month>/<day>/<year>')
+@query_budget(2)
+async def list_appointments_for_doctor_on_day(doctor_id, month, day, year):
+    """ Same as list_appointments_for_doctor_on_day in app.py, 404 if the
+        doctor doesn't exist
+    """
+    date = f"{month}/{day}/{year}"
+
+    async with async_session() as session:
+        doctor = await session.get(Doctor, doctor_id)
+
+        if doctor is None:
+            abort(404)
+
+        # doctor.appointments can't lazy load in async, so filter in the query
+        appointments = (await session.execute(
+            select(Appointment)
+            .where(Appointment.doctor_id == doctor_id)
+            .where(Appointment.date == date)
+        )).scalars().all()
+
+    return jsonify({"appointments":[appointment.serialize() for appointment in appointments]})
@@ -0,0 +1,5 @@
+import os
+
+# Database URI needs to be changed to the name of your database, or set the
+# DATABASE_URL environment variable. app.py and async_app.py both use this.
+DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///doctor-calendar') # Here
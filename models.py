@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 
 db = SQLAlchemy()
 
@@ -90,6 +91,57 @@ class Appointment(db.Model):
             "doctor_id":doctor_id
         }
 
+class ListingVersion(db.Model):
+    """ One row per cached listing ("doctors", "appointments"). A trigger
+        bumps version on every write to the listing's table, from any process
+        or from psql, so a cached listing is only reused while it matches.
+    """
+    __tablename__ = 'listing_versions'
+
+    name = db.Column(
+        db.String(20),
+        primary_key=True
+    )
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+# Runs after every db.create_all(), so databases made before this table
+# existed get the rows and triggers too. Every worker runs it when it starts,
+# the advisory lock makes them take turns until create_all's transaction ends.
+event.listen(db.Model.metadata, 'after_create', DDL("""
+SELECT pg_advisory_xact_lock(4242001);
+
+INSERT INTO listing_versions (name, version)
+VALUES ('doctors', 0), ('appointments', 0)
+ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_listing_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE listing_versions SET version = version + 1 WHERE name = TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'doctors_listing_version') THEN
+        CREATE TRIGGER doctors_listing_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON doctors
+        FOR EACH STATEMENT EXECUTE PROCEDURE bump_listing_version('doctors');
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'appointments_listing_version') THEN
+        CREATE TRIGGER appointments_listing_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON appointments
+        FOR EACH STATEMENT EXECUTE PROCEDURE bump_listing_version('appointments');
+    END IF;
+END;
+$$;
+"""))
+
 def connect_db(app):
     """ Connects to database """
     db.app = app
@@ -0,0 +1,103 @@
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Quart is only needed for async_app.py
+try:
+    import quart
+except ImportError:
+    quart = None
+
+# Statements run by the current request, None outside a route with a budget.
+# A context variable works for both apps, Flask runs each request in its own
+# thread and Quart in its own task. SQLAlchemy's async engine passes it on to
+# the greenlet where the statement really runs.
+_query_log = ContextVar("query_log", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    """ Raised in TESTING mode when a route runs more statements than its
+        budget allows, usually because of an N+1 query.
+    """
+
+@event.listens_for(Engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    query_log = _query_log.get()
+
+    if query_log is not None:
+        query_log.append(statement)
+
+def check_budget(statements, max_statements):
+    """ Logs a warning, or raises QueryBudgetExceeded in TESTING mode, if
+        more statements than max_statements were run by the current request
+    """
+
+    if len(statements) <= max_statements:
+        return
+
+    # Async views can run under Quart (async_app.py) or Flask (app.py), so
+    # use whichever one is handling this request
+    if quart is not None and quart.has_request_context():
+        app, endpoint = quart.current_app, quart.request.endpoint
+    else:
+        app, endpoint = current_app, request.endpoint
+
+    message = (
+        f"{endpoint} ran {len(statements)} statements, "
+        f"budget is {max_statements}:\n" + "\n".join(statements)
+    )
+
+    if app.config.get("TESTING"):
+        raise QueryBudgetExceeded(message)
+
+    app.logger.warning(message)
+
+def query_budget(max_statements):
+    """ Declares the most SQL statements a route may run. Goes under the
+        route decorator like:
+            @app.get('/doctors')
+            @query_budget(2)
+            def list_doctors():
+
+        Works on sync and async views, in app.py and async_app.py.
+        Going over the budget logs a warning with the statements, or raises
+        QueryBudgetExceeded if app.config['TESTING'] is True.
+
+        The budget is checked when the view raises too, a route can run an
+        N+1 before a 404. In TESTING the QueryBudgetExceeded is raised with
+        the view's exception as its context, otherwise the view's exception
+        carries on as normal.
+    """
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(*args, **kwargs):
+                token = _query_log.set([])
+
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    statements = _query_log.get()
+                    _query_log.reset(token)
+                    check_budget(statements, max_statements)
+        else:
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                token = _query_log.set([])
+
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    statements = _query_log.get()
+                    _query_log.reset(token)
+                    check_budget(statements, max_statements)
+
+        wrapper.query_budget = max_statements
+        return wrapper
+
+    return decorator
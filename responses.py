@@ -0,0 +1,217 @@
+import gzip
+import threading
+
+from flask import current_app, jsonify, request
+
+from models import db, ListingVersion
+
+# Brotli is in requirements.txt, if it's missing clients that ask for br get gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this (in bytes) are sent uncompressed, the headers
+# would cost more than the bytes saved. Can be changed with COMPRESS_MIN_SIZE
+DEFAULT_MIN_SIZE = 500
+
+# Cached listings are compressed once per version and reused, so they get a
+# higher level. Not br 11 though, the first request after every write waits
+# for it. Everything else is compressed per request and uses a cheaper level.
+CACHED_LEVELS = {"br": 6, "gzip": 9}
+PER_REQUEST_LEVELS = {"br": 5, "gzip": 6}
+
+
+def compress(body, encoding, level):
+    """ Compresses bytes with "br" or "gzip" and returns the compressed bytes """
+
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+
+    return gzip.compress(body, compresslevel=level)
+
+def negotiate_encoding(accept_encodings):
+    """ Picks the best encoding the client accepts, from the request's parsed
+        Accept-Encoding header. Returns "br", "gzip" or None for no compression.
+    """
+
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    return accept_encodings.best_match(offered)
+
+def should_compress(body, min_size):
+    """ Returns True if the body is big enough to be worth compressing """
+
+    return len(body) >= min_size
+
+# The helpers below are given the parsed Accept-Encoding header and the
+# minimum size instead of reading Flask's request and config themselves
+def is_compressible(response):
+    """ Returns True for JSON responses with a body that aren't compressed yet """
+
+    return not (getattr(response, "direct_passthrough", False)
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers)
+
+def compress_body(response, body, accept_encodings, min_size):
+    """ Replaces the response's body, already read into body, with a
+        compressed copy if the client accepts it and it's big enough.
+    """
+
+    response.vary.add("Accept-Encoding")
+
+    encoding = negotiate_encoding(accept_encodings)
+
+    if encoding is None or not should_compress(body, min_size):
+        return response
+
+    response.set_data(compress(body, encoding, PER_REQUEST_LEVELS[encoding]))
+    response.headers["Content-Encoding"] = encoding
+
+    return response
+
+def listing_encoding(listing, accept_encodings, min_size):
+    """ Returns the encoding to send an EncodedListing with, None if the
+        client doesn't accept one or the body is too small to bother.
+    """
+
+    if not should_compress(listing.body, min_size):
+        return None
+
+    return negotiate_encoding(accept_encodings)
+
+def listing_response(response_class, body, mimetype, encoding):
+    """ Makes a response from a listing body already encoded with encoding,
+        from EncodedListing.get
+    """
+
+    response = response_class(body, mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+
+    return response
+
+############################# Listing cache ####################################
+class EncodedListing:
+    """ A full listing already turned into JSON bytes. Compressed copies are
+        made the first time an encoding is asked for and kept after that.
+        Requests asking at the same time wait for the first one to finish
+        instead of compressing the same body again.
+    """
+
+    def __init__(self, body, mimetype, version):
+        self.body = body
+        self.mimetype = mimetype
+        self.version = version
+        self.encoded = {}
+        self.lock = threading.Lock()
+
+    def get(self, encoding):
+        """ Returns the body for the encoding, None gives the plain JSON """
+
+        if encoding is None:
+            return self.body
+
+        with self.lock:
+            if encoding not in self.encoded:
+                self.encoded[encoding] = compress(
+                    self.body, encoding, CACHED_LEVELS[encoding])
+
+            return self.encoded[encoding]
+
+class ListingCache:
+    """ Encoded listings kept in this process, each tagged with the
+        listing_versions row it was built at. Every process has its own
+        cache, they stay correct because each lookup checks the version in
+        the database, which triggers bump on any write to the table.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}
+
+    def get(self, name, version):
+        """ Returns the cached listing if it was built at version, else None """
+
+        with self.lock:
+            listing = self.listings.get(name)
+
+        if listing is None or listing.version != version:
+            return None
+
+        return listing
+
+    def put(self, name, listing):
+        """ Stores the listing unless a newer version is already cached """
+
+        with self.lock:
+            cached = self.listings.get(name)
+
+            if cached is None or cached.version < listing.version:
+                self.listings[name] = listing
+
+listings = ListingCache()
+
+def listing_version(name):
+    """ Returns the current version of the listing from listing_versions """
+
+    # Queries the column, not the model, so the identity map can't answer
+    # with a version loaded earlier in the session
+    return db.session.query(ListingVersion.version).filter_by(name=name).scalar()
+
+def cached_listing(name, build):
+    """ Returns a response for the listing called name. build is only called
+        if the listing changed since it was cached, it must return the data to
+        send as JSON. The response is compressed if the client accepts it and
+        the body is big enough.
+    """
+
+    # Read before build, so the rows built are at least as new as the version
+    # they are stored under
+    version = listing_version(name)
+    listing = listings.get(name, version)
+
+    if listing is None:
+        response = jsonify(build())
+        listing = EncodedListing(response.get_data(), response.mimetype, version)
+
+        if version is not None:
+            listings.put(name, listing)
+
+    encoding = listing_encoding(
+        listing,
+        request.accept_encodings,
+        current_app.config["COMPRESS_MIN_SIZE"]
+    )
+
+    return listing_response(
+        current_app.response_class,
+        listing.get(encoding),
+        listing.mimetype,
+        encoding
+    )
+
+############################# Compression ######################################
+def compress_response(response):
+    """ Compresses JSON responses that weren't already compressed by the
+        listing cache, if the client accepts it and the body is big enough.
+    """
+
+    if not is_compressible(response):
+        return response
+
+    return compress_body(
+        response,
+        response.get_data(),
+        request.accept_encodings,
+        current_app.config["COMPRESS_MIN_SIZE"]
+    )
+
+def connect_compression(app):
+    """ Compresses the app's JSON responses """
+    app.config.setdefault("COMPRESS_MIN_SIZE", DEFAULT_MIN_SIZE)
+    app.after_request(compress_response)
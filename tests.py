@@ -1,14 +1,25 @@
-from unittest import TestCase
+import gzip
+import os
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
 
-from app import app, db
-from models import Doctor, Appointment
-from flask import json
+# Database URI needs to be changed to the name of your test database.
+# Set before importing the apps, both read it when they're imported.
+os.environ['DATABASE_URL'] = "postgresql:///doctor-calendar-test" # Here
 
-# Database URI needs to be changed to the name of your test database
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///doctor-calendar-test" # Here
+from app import app, db
+from async_app import app as async_app, asyncpg_url
+from models import Doctor, Appointment, ListingVersion
+from query_budget import query_budget, QueryBudgetExceeded
+from flask import abort, json
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import NotFound
+from responses import brotli, cached_listing, listings
 
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
+async_app.config['TESTING'] = True
 
 db.create_all()
 
@@ -109,6 +120,124 @@ class DoctorViewTestCase(TestCase):
                     }
                 }, response)
 
+    def test_list_doctors_cache_invalidated(self):
+        with self.client as c:
+            c.get("/doctors")
+
+            c.post("/doctors",
+            json={
+                "first_name":"new_first",
+                "last_name":"new_last"
+            })
+
+            resp = c.get("/doctors")
+            doctors = json.loads(resp.get_data(as_text=True))
+
+            self.assertIn("new_first", [doctor["first_name"] for doctor in doctors])
+
+    def test_list_doctors_cache_invalidated_outside_app(self):
+        with self.client as c:
+            c.get("/doctors")
+
+            # Like a write from psql or another worker, the app's session
+            # never sees it
+            with db.engine.begin() as conn:
+                conn.execute(text(
+                    "INSERT INTO doctors (first_name, last_name) "
+                    "VALUES ('outside_first', 'outside_last')"))
+
+            resp = c.get("/doctors")
+            doctors = json.loads(resp.get_data(as_text=True))
+
+            self.assertIn("outside_first", [doctor["first_name"] for doctor in doctors])
+
+    def test_list_doctors_compressed(self):
+        with self.client as c:
+            min_size = app.config['COMPRESS_MIN_SIZE']
+            app.config['COMPRESS_MIN_SIZE'] = 0
+
+            try:
+                resp = c.get("/doctors", headers={"Accept-Encoding":"gzip"})
+                resp2 = c.get("/doctors")
+            finally:
+                app.config['COMPRESS_MIN_SIZE'] = min_size
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+
+            doctors = json.loads(gzip.decompress(resp.get_data()))
+
+            self.assertIn({
+                "first_name":"test_first",
+                "last_name":"test_last",
+                "id":self.doctor_id
+            }, doctors)
+
+            # Clients that don't ask for compression get plain JSON
+            self.assertNotIn("Content-Encoding", resp2.headers)
+            self.assertEqual(json.loads(resp2.get_data(as_text=True)), doctors)
+
+    def test_list_doctors_compressed_brotli(self):
+        if brotli is None:
+            self.skipTest("Brotli isn't installed")
+
+        with self.client as c:
+            min_size = app.config['COMPRESS_MIN_SIZE']
+            app.config['COMPRESS_MIN_SIZE'] = 0
+
+            try:
+                resp = c.get("/doctors", headers={"Accept-Encoding":"br, gzip"})
+            finally:
+                app.config['COMPRESS_MIN_SIZE'] = min_size
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Content-Encoding"], "br")
+
+            doctors = json.loads(brotli.decompress(resp.get_data()))
+
+            self.assertIn({
+                "first_name":"test_first",
+                "last_name":"test_last",
+                "id":self.doctor_id
+            }, doctors)
+
+    def test_list_doctors_cache_hit(self):
+        with self.client as c:
+            c.get("/doctors")
+
+            statements = []
+
+            def record(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            event.listen(db.engine, "before_cursor_execute", record)
+
+            try:
+                resp = c.get("/doctors")
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+            self.assertEqual(resp.status_code, 200)
+
+            # Only the version check, the doctors table isn't read
+            self.assertEqual(len(statements), 1)
+            self.assertIn("listing_versions", statements[0])
+
+    def test_cached_listing_builds_once(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return [doctor.serialize() for doctor in Doctor.query.all()]
+
+        with app.test_request_context("/doctors"):
+            first = cached_listing("doctors", build)
+            second = cached_listing("doctors", build)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(first.get_data(), second.get_data())
+
 class AppointmentViewTestCase(TestCase):
     """Test views for appointments."""
 
@@ -211,6 +340,39 @@ class AppointmentViewTestCase(TestCase):
                 "doctor_id":self.second_doctor_id,
                 "id":self.third_test_appointment_id
             }, appointments)
+
+    def test_list_appointments_cache_invalidated(self):
+        with self.client as c:
+            c.get("/appointments")
+
+            c.delete(f"/appointments/{self.test_appointment_id}")
+
+            resp = c.get("/appointments")
+            appointments = json.loads(resp.get_data(as_text=True))
+            ids = [appointment["id"] for appointment in appointments]
+
+            self.assertNotIn(self.test_appointment_id, ids)
+            self.assertIn(self.second_test_appointment_id, ids)
+
+    def test_booking_keeps_doctors_cache(self):
+        def doctors_version():
+            return db.session.query(ListingVersion.version).filter_by(
+                name="doctors").scalar()
+
+        with self.client as c:
+            before = doctors_version()
+
+            resp = c.post(f"/appointments/{self.doctor_id}",
+            json={
+                    "patient_first_name":"Test_fn",
+                    "patient_last_name":"Test_ln",
+                    "date":"1/11/2000",
+                    "time":"9:00AM",
+                    "kind":"New Patient"
+            })
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(doctors_version(), before)
     
     def test_list_appointments_for_doctor_on_day(self):
         with self.client as c:
@@ -405,3 +567,289 @@ class AppointmentViewTestCase(TestCase):
             response4 = json.loads(responseJSON4)
             
             self.assertEqual({"error":f"Doctor already has 3 appointments on 1/11/2000 at 8:00AM. Choose another day please."}, response4)
+
+class QueryBudgetTestCase(TestCase):
+    """Test query budgets on routes."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Appointment.query.delete()
+        Doctor.query.delete()
+
+        self.client = app.test_client()
+
+        test_doctor = Doctor(
+            first_name="test_first",
+            last_name="test_last"
+        )
+
+        second_doctor = Doctor(
+            first_name="test_first_two",
+            last_name="test_last_two"
+        )
+
+        db.session.add_all([test_doctor, second_doctor])
+        db.session.commit()
+
+        # Enough rows that one query per row would go over any budget
+        appointments = [
+            Appointment(
+                patient_first_name=f"test_fn_{i}",
+                patient_last_name=f"test_ln_{i}",
+                date="1/11/2000",
+                time="8:00AM",
+                kind="New Patient",
+                doctor_id=test_doctor.id
+            ) for i in range(10)
+        ]
+
+        db.session.add_all(appointments)
+        db.session.commit()
+
+        self.doctor_id = test_doctor.id
+        self.test_appointment_id = appointments[0].id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def test_every_route_has_budget(self):
+        for each_app in [app, async_app]:
+            for endpoint, view in each_app.view_functions.items():
+                if endpoint == "static":
+                    continue
+
+                self.assertTrue(hasattr(view, "query_budget"), endpoint)
+
+    def test_routes_within_budget(self):
+        # TESTING mode raises QueryBudgetExceeded if a route goes over
+        with self.client as c:
+            self.assertEqual(c.get("/doctors").status_code, 200)
+            self.assertEqual(c.get(f"/doctors/{self.doctor_id}").status_code, 200)
+            self.assertEqual(c.get("/appointments").status_code, 200)
+            self.assertEqual(
+                c.get(f"/appointments/{self.doctor_id}/1/11/2000").status_code, 200)
+            self.assertEqual(
+                c.post(f"/appointments/{self.doctor_id}",
+                json={
+                    "patient_first_name":"Test_fn",
+                    "patient_last_name":"Test_ln",
+                    "date":"1/11/2000",
+                    "time":"9:00AM",
+                    "kind":"Follow-up"
+                }).status_code, 201)
+            self.assertEqual(
+                c.delete(f"/appointments/{self.test_appointment_id}").status_code, 200)
+
+    def test_budget_exceeded_raises_in_testing(self):
+        @query_budget(1)
+        def over_budget():
+            Doctor.query.all()
+            Appointment.query.all()
+            return "ok"
+
+        with app.test_request_context("/"):
+            with self.assertRaises(QueryBudgetExceeded):
+                over_budget()
+
+    def test_budget_exceeded_logs_in_production(self):
+        @query_budget(1)
+        def over_budget():
+            Doctor.query.all()
+            Appointment.query.all()
+            return "ok"
+
+        app.config['TESTING'] = False
+
+        try:
+            with app.test_request_context("/"):
+                with self.assertLogs(app.logger, level="WARNING") as logs:
+                    self.assertEqual(over_budget(), "ok")
+        finally:
+            app.config['TESTING'] = True
+
+        self.assertIn("ran 2 statements, budget is 1", logs.output[0])
+        self.assertIn("appointments", logs.output[0])
+
+    def test_n_plus_one_route_fails(self):
+        serialize = Doctor.serialize
+
+        # A regression where /doctors lazy loads each doctor's appointments
+        def serialize_with_appointments(doctor):
+            return {**serialize(doctor), "appointments":len(doctor.appointments)}
+
+        with self.client as c:
+            with patch.object(Doctor, "serialize", serialize_with_appointments):
+                with self.assertRaises(QueryBudgetExceeded):
+                    c.get("/doctors")
+
+    def test_budget_checked_when_view_raises(self):
+        @query_budget(1)
+        def over_budget_then_404():
+            Doctor.query.all()
+            Appointment.query.all()
+            abort(404)
+
+        with app.test_request_context("/"):
+            with self.assertRaises(QueryBudgetExceeded) as raised:
+                over_budget_then_404()
+
+        # The view's own error isn't lost
+        self.assertIsInstance(raised.exception.__context__, NotFound)
+
+class AsyncReadTestCase(IsolatedAsyncioTestCase):
+    """Test the async read routes return the same JSON as app.py."""
+
+    async def asyncSetUp(self):
+        """Start the async app, add sample data."""
+
+        Appointment.query.delete()
+        Doctor.query.delete()
+
+        test_doctor = Doctor(
+            first_name="test_first",
+            last_name="test_last"
+        )
+
+        db.session.add(test_doctor)
+        db.session.commit()
+
+        test_appointment = Appointment(
+            patient_first_name="test_fn",
+            patient_last_name="test_ln",
+            date="1/11/2000",
+            time="8:00AM",
+            kind="New Patient",
+            doctor_id=test_doctor.id
+        )
+
+        other_day_appointment = Appointment(
+            patient_first_name="bad_test_fn",
+            patient_last_name="bad_test_ln",
+            date="1/12/2000",
+            time="8:00AM",
+            kind="New Patient",
+            doctor_id=test_doctor.id
+        )
+
+        db.session.add_all([test_appointment, other_day_appointment])
+        db.session.commit()
+
+        self.doctor_id = test_doctor.id
+
+        self.client = app.test_client()
+
+        self.test_app = async_app.test_app()
+        await self.test_app.startup()
+        self.async_client = self.test_app.test_client()
+
+    async def asyncTearDown(self):
+        """Close the async pool, clean up any fouled transaction."""
+        await self.test_app.shutdown()
+        db.session.rollback()
+
+    async def test_same_json_as_sync(self):
+        urls = [
+            "/doctors",
+            f"/doctors/{self.doctor_id}",
+            "/appointments",
+            f"/appointments/{self.doctor_id}/1/11/2000"
+        ]
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        for url in urls:
+            # Both apps share the listing cache in this process. Empty it
+            # before each request so each app builds its own JSON.
+            listings.listings.clear()
+            resp = self.client.get(url)
+
+            listings.listings.clear()
+            statements.clear()
+            event.listen(Engine, "before_cursor_execute", record)
+
+            try:
+                async_resp = await self.async_client.get(url)
+            finally:
+                event.remove(Engine, "before_cursor_execute", record)
+
+            self.assertEqual(async_resp.status_code, 200)
+
+            # The async app read the rows itself, not just the listing version
+            self.assertTrue(
+                [statement for statement in statements
+                    if "listing_versions" not in statement], url)
+
+            expected = json.loads(resp.get_data(as_text=True))
+            actual = json.loads(await async_resp.get_data(as_text=True))
+
+            # Neither app orders its rows, so only compare what's in the lists
+            if isinstance(expected, dict) and "appointments" in expected:
+                expected = expected["appointments"]
+                actual = actual["appointments"]
+
+            if isinstance(expected, list):
+                self.assertCountEqual(actual, expected)
+            else:
+                self.assertEqual(actual, expected)
+
+    async def test_listing_cache_hit(self):
+        await self.async_client.get("/appointments")
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", record)
+
+        try:
+            resp = await self.async_client.get("/appointments")
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+
+        self.assertEqual(resp.status_code, 200)
+
+        # Only the version check, the appointments table isn't read
+        self.assertEqual(len(statements), 1)
+        self.assertIn("listing_versions", statements[0])
+
+    async def test_listing_cache_invalidated_by_sync_app(self):
+        await self.async_client.get("/doctors")
+
+        self.client.post("/doctors",
+        json={
+            "first_name":"new_first",
+            "last_name":"new_last"
+        })
+
+        resp = await self.async_client.get("/doctors")
+        doctors = json.loads(await resp.get_data(as_text=True))
+
+        self.assertIn("new_first", [doctor["first_name"] for doctor in doctors])
+
+    async def test_asyncpg_url(self):
+        url, connect_args = asyncpg_url(
+            "postgresql+psycopg2://user@db/doctor-calendar"
+            "?sslmode=require&connect_timeout=5&sslrootcert=root.crt")
+
+        self.assertEqual(url.drivername, "postgresql+asyncpg")
+        self.assertEqual(url.database, "doctor-calendar")
+        self.assertEqual(dict(url.query), {})
+        self.assertEqual(connect_args, {"ssl":"require", "timeout":5.0})
+
+        url2, connect_args2 = asyncpg_url("postgres:///doctor-calendar")
+
+        self.assertEqual(url2.drivername, "postgresql+asyncpg")
+        self.assertEqual(connect_args2, {})
+
+    async def test_not_found(self):
+        resp = await self.async_client.get("/doctors/1000000")
+        self.assertEqual(resp.status_code, 404)
+
+        resp2 = await self.async_client.get("/appointments/1000000/1/11/2000")
+        self.assertEqual(resp2.status_code, 404)